@@ -0,0 +1,118 @@
+"""Shared subprocess helper for running gcloud commands."""
+
+import collections
+import logging
+import os
+import select
+import shlex
+import signal
+import subprocess
+import time
+from typing import List, Optional, Tuple, Union
+
+
+logger = logging.getLogger(__name__)
+
+# How many trailing output lines to keep when streaming; enough to diagnose
+# a failed pip install or docker build without buffering the full log.
+_STREAM_TAIL_LINES = 200
+
+
+def run_command(
+    command: Union[str, List[str]],
+    timeout: Optional[int] = None,
+    stream: bool = False,
+) -> Tuple[str, str, int]:
+    """
+    Run a command and capture its output.
+
+    Args:
+        command (Union[str, List[str]]): The command to execute, either as a
+            pre-built argv list or a string to tokenize.
+        timeout (Optional[int]): Seconds to wait before giving up, or None to
+            wait indefinitely.
+        stream (bool): If True, forward output lines to the logger as they
+            arrive and keep only a bounded tail instead of buffering the
+            whole log in memory. stderr is merged into stdout.
+
+    Returns:
+        Tuple[str, str, int]: A tuple containing the command's stdout, stderr, and return code.
+    """
+    args = shlex.split(command) if isinstance(command, str) else command
+    # Skip the shlex.join/format work entirely when INFO is disabled; this
+    # runs for every gcloud invocation.
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("Running command: %s", shlex.join(args))
+    if stream:
+        return _run_streaming(args, timeout)
+    # Run in its own process group so a timeout can kill the whole tree:
+    # gcloud forks an ssh child that would otherwise survive (and keep the
+    # remote session open) if only the parent were killed.
+    process = subprocess.Popen(
+        args,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True,
+        start_new_session=True,
+    )
+    try:
+        stdout, stderr = process.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        process.communicate()
+        return "", f"Command timed out after {timeout}s", 1
+    return stdout, stderr, process.returncode
+
+
+def _run_streaming(args: List[str], timeout: Optional[int]) -> Tuple[str, str, int]:
+    """Run a command, logging output incrementally and keeping only a tail.
+
+    `pip install` and `docker build` emit tens of MB; buffering that per
+    concurrent worker adds up on the driver, and the full log is only
+    interesting when the command fails — for which the tail suffices.
+    """
+    process = subprocess.Popen(
+        args,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        start_new_session=True,
+    )
+    # Read the raw fd: select on a buffered text stream misses lines that a
+    # readline already pulled into Python's buffer, and a partial line
+    # followed by a stall would block readline past the deadline.
+    fd = process.stdout.fileno()
+    tail = collections.deque(maxlen=_STREAM_TAIL_LINES)
+    pending = b""
+    deadline = time.monotonic() + timeout if timeout else None
+    try:
+        while True:
+            remaining = 10.0
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return "".join(tail), f"Command timed out after {timeout}s", 1
+            readable, _, _ = select.select([fd], [], [], min(remaining, 10))
+            if not readable:
+                continue
+            chunk = os.read(fd, 4096)
+            if not chunk:
+                break
+            *lines, pending = (pending + chunk).split(b"\n")
+            for raw_line in lines:
+                line = raw_line.decode(errors="replace")
+                if logger.isEnabledFor(logging.INFO):
+                    logger.info(line)
+                tail.append(line + "\n")
+        if pending:
+            tail.append(pending.decode(errors="replace"))
+        return "".join(tail), "", process.wait()
+    finally:
+        if process.poll() is None:
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            process.communicate()
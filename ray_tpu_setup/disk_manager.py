@@ -2,11 +2,18 @@
 
 import argparse
 import dataclasses
+import getpass
+import glob
 import logging
 import os
+import shlex
+import signal
 import subprocess
 import time
-from typing import Optional, Tuple, List, Dict, Any
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Tuple, List, Dict, Any, Union
+
+from . import _shell
 
 
 logging.basicConfig(
@@ -27,30 +34,30 @@ class VMConfig:
 class DiskConfig:
     name: str
     size_gb: int
-    type: str = "pd-balanced"
+    type: str = "pd-ssd"
+    provisioned_iops: Optional[int] = None
+    provisioned_throughput: Optional[int] = None
 
 
 class GCSVMManager:
+    _CONTROL_PATH = "/tmp/ray-tpu-setup-cm-%r@%h:%p"
+
     def __init__(self, project: str, zone: str):
         self.project = project
         self.zone = zone
 
-    def run_command(self, command: str) -> Tuple[str, str, int]:
+    def run_command(self, command: Union[str, List[str]]) -> Tuple[str, str, int]:
         """
-        Execute a shell command and capture its output.
+        Execute a command and capture its output.
 
         Args:
-            command (str): The shell command to execute.
+            command (Union[str, List[str]]): The command to execute, either as
+                a pre-built argv list or a string to tokenize.
 
         Returns:
             Tuple[str, str, int]: A tuple containing the command's stdout, stderr, and return code.
         """
-        logger.info(f"Running command: {command}")
-        process = subprocess.Popen(
-            command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True
-        )
-        output, error = process.communicate()
-        return output.decode("utf-8"), error.decode("utf-8"), process.returncode
+        return _shell.run_command(command)
 
     def run_on_vm(
         self, vm_name: str, command: str, use_google_proxy: bool = False
@@ -66,14 +73,44 @@ class GCSVMManager:
         Returns:
             Tuple[str, str, int]: A tuple containing the command's stdout, stderr, and return code.
         """
-        ssh_command = (
-            f"gcloud compute ssh {vm_name} --zone={self.zone} --project={self.project}"
-        )
-        vm_command = f'{ssh_command} --command="{command}"'
-        if use_google_proxy:
-            vm_command += " -- -o ProxyCommand='corp-ssh-helper %h %p'"
+        vm_command = [
+            "gcloud",
+            "compute",
+            "ssh",
+            vm_name,
+            f"--zone={self.zone}",
+            f"--project={self.project}",
+            f"--command={command}",
+        ] + self._ssh_options(use_google_proxy)
         return self.run_command(vm_command)
 
+    def _ssh_options(self, use_google_proxy: bool) -> List[str]:
+        """Build the trailing ssh options shared by every SSH to a VM.
+
+        Multiplexes over a shared control socket so only the first call to a
+        VM pays the SSH handshake; later calls reuse the connection.
+        """
+        options = [
+            "--",
+            "-o",
+            "ControlMaster=auto",
+            "-o",
+            f"ControlPath={self._CONTROL_PATH}",
+            "-o",
+            "ControlPersist=600s",
+        ]
+        if use_google_proxy:
+            options += ["-o", "ProxyCommand=corp-ssh-helper %h %p"]
+        return options
+
+    def close(self) -> None:
+        """Close any SSH control sockets opened by run_on_vm."""
+        for socket_path in glob.glob("/tmp/ray-tpu-setup-cm-*"):
+            subprocess.run(
+                ["ssh", "-O", "exit", "-o", f"ControlPath={socket_path}", "unused"],
+                capture_output=True,
+            )
+
     def get_bucket_size(self, gcs_path: str) -> int:
         """
         Get the size of a GCS bucket or path.
@@ -87,15 +124,80 @@ class GCSVMManager:
         Raises:
             Exception: If the command fails.
         """
-        command = f"gsutil du -s {gcs_path}"
-        output, error, rc = self.run_command(command)
-        if rc != 0:
+        command = f"gcloud storage du -s {gcs_path}"
+        logger.info(f"Running command: {command}")
+        process = subprocess.Popen(
+            shlex.split(command),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True,
+        )
+        # Stream line by line so memory stays O(1) even if the command is
+        # chatty; only the final summary line matters.
+        last_line = ""
+        for line in process.stdout:
+            if line.strip():
+                last_line = line
+        _, error = process.communicate()
+        if process.returncode != 0:
             raise Exception(f"Failed to get bucket size: {error}")
-        size_bytes = int(output.split()[0])
+        size_bytes = int(last_line.split()[0])
         return (
             size_bytes // (1024 * 1024 * 1024) + 5
         )  # Convert to GB and add 5GB buffer
 
+    def get_object_count(self, gcs_path: str, limit: int = 10000) -> Optional[int]:
+        """
+        Count the objects under a GCS path, stopping once `limit` is passed.
+
+        The count only feeds an advisory warning, so the listing is
+        abandoned as soon as the threshold is crossed (a full recursive
+        listing of a large bucket can take minutes) and a failed probe is
+        reported as None rather than raised.
+
+        Args:
+            gcs_path (str): The GCS path to check.
+            limit (int): Stop counting once this many objects are seen.
+
+        Returns:
+            Optional[int]: The number of objects counted (capped just above
+                `limit`), or None if the listing failed.
+        """
+        command = f"gcloud storage ls -r {gcs_path}"
+        logger.info(f"Running command: {command}")
+        process = subprocess.Popen(
+            shlex.split(command),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True,
+            start_new_session=True,
+        )
+        count = 0
+        try:
+            for line in process.stdout:
+                line = line.strip()
+                # Skip prefix headers and directory placeholders.
+                if line and not line.endswith("/") and not line.endswith(":"):
+                    count += 1
+                    if count > limit:
+                        return count
+            _, error = process.communicate()
+            if process.returncode != 0:
+                logger.warning(
+                    f"Could not count objects under {gcs_path}: {error.strip()}"
+                )
+                return None
+            return count
+        finally:
+            if process.poll() is None:
+                # Kill the whole group so the abandoned listing doesn't
+                # leave children behind.
+                try:
+                    os.killpg(process.pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+                process.wait()
+
     def get_bucket_region(self, gcs_path: str) -> str:
         """
         Get the region of a GCS bucket.
@@ -110,11 +212,14 @@ class GCSVMManager:
             Exception: If the command fails.
         """
         bucket_name = gcs_path.split("/")[2]
-        command = f"gsutil ls -L -b gs://{bucket_name} | grep 'Location constraint:'"
+        command = (
+            f"gcloud storage buckets describe gs://{bucket_name} "
+            "--format='value(location)'"
+        )
         output, error, rc = self.run_command(command)
         if rc != 0:
             raise Exception(f"Failed to get bucket region: {error}")
-        return output.split(":")[1].strip()
+        return output.strip()
 
     def create_disk(self, **kwargs: Any) -> None:
         """
@@ -126,17 +231,33 @@ class GCSVMManager:
                     name (str): Name of the disk.
                     size_gb (int): Size of the disk in GB.
                 Optional:
-                    type (str): Type of the disk. Default is 'pd-balanced'.
+                    type (str): Type of the disk. Default is 'pd-ssd'.
+                    provisioned_iops (int): IOPS to provision (hyperdisk only).
+                    provisioned_throughput (int): Throughput in MB/s to provision
+                        (hyperdisk only).
 
         Raises:
             Exception: If the command fails.
         """
         disk_config = DiskConfig(**kwargs)
-        command = f"""
-        gcloud compute disks create {disk_config.name} \
-        --zone={self.zone} --project={self.project} \
-        --size={disk_config.size_gb}GB --type={disk_config.type}
-        """
+        command = [
+            "gcloud",
+            "compute",
+            "disks",
+            "create",
+            disk_config.name,
+            f"--zone={self.zone}",
+            f"--project={self.project}",
+            f"--size={disk_config.size_gb}GB",
+            f"--type={disk_config.type}",
+        ]
+        if disk_config.type.startswith("hyperdisk-"):
+            if disk_config.provisioned_iops:
+                command.append(f"--provisioned-iops={disk_config.provisioned_iops}")
+            if disk_config.provisioned_throughput:
+                command.append(
+                    f"--provisioned-throughput={disk_config.provisioned_throughput}"
+                )
         _, error, rc = self.run_command(command)
         if rc != 0:
             raise Exception(f"Failed to create disk: {error}")
@@ -156,11 +277,16 @@ class GCSVMManager:
             Exception: If the command fails.
         """
         vm_config = VMConfig(zone=self.zone, project=self.project, **kwargs)
-        command = f"""
-        gcloud compute instances create {vm_config.name} \
-        --zone={vm_config.zone} --project={vm_config.project} \
-        --machine-type={vm_config.machine_type}
-        """
+        command = [
+            "gcloud",
+            "compute",
+            "instances",
+            "create",
+            vm_config.name,
+            f"--zone={vm_config.zone}",
+            f"--project={vm_config.project}",
+            f"--machine-type={vm_config.machine_type}",
+        ]
         _, error, rc = self.run_command(command)
         if rc != 0:
             raise Exception(f"Failed to create VM: {error}")
@@ -176,10 +302,16 @@ class GCSVMManager:
         Raises:
             Exception: If the command fails.
         """
-        command = f"""
-        gcloud compute instances attach-disk {vm_name} \
-        --disk={disk_name} --zone={self.zone} --project={self.project}
-        """
+        command = [
+            "gcloud",
+            "compute",
+            "instances",
+            "attach-disk",
+            vm_name,
+            f"--disk={disk_name}",
+            f"--zone={self.zone}",
+            f"--project={self.project}",
+        ]
         _, error, rc = self.run_command(command)
         if rc != 0:
             raise Exception(f"Failed to attach disk: {error}")
@@ -201,10 +333,11 @@ class GCSVMManager:
             "sudo mount -o discard,defaults /dev/sdb /mnt/disks/persist",
             "sudo chmod a+w /mnt/disks/persist",
         ]
-        for command in commands:
-            _, error, rc = self.run_on_vm(vm_name, command, use_google_proxy)
-            if rc != 0:
-                raise Exception(f"Failed to format and mount disk: {error}")
+        # Run all steps in one SSH session; each separate gcloud ssh call
+        # pays a full connection handshake.
+        _, error, rc = self.run_on_vm(vm_name, " && ".join(commands), use_google_proxy)
+        if rc != 0:
+            raise Exception(f"Failed to format and mount disk: {error}")
 
     def download_from_gcs(
         self, vm_name: str, gcs_path: str, use_google_proxy: bool
@@ -220,26 +353,42 @@ class GCSVMManager:
         Raises:
             Exception: If the download fails.
         """
-        command = f"gsutil -m cp -R {gcs_path} /mnt/disks/persist/"
-        ssh_command = (
-            f"gcloud compute ssh {vm_name} --zone={self.zone} --project={self.project}"
-        )
-        full_command = f'{ssh_command} --command="{command}"'
-        if use_google_proxy:
-            full_command += " -- -o ProxyCommand='corp-ssh-helper %h %p'"
-
+        command = f"gcloud storage cp -r --no-clobber {gcs_path} /mnt/disks/persist/"
+        full_command = [
+            "gcloud",
+            "compute",
+            "ssh",
+            vm_name,
+            f"--zone={self.zone}",
+            f"--project={self.project}",
+            f"--command={command}",
+        ] + self._ssh_options(use_google_proxy)
+
+        # Line-buffered and in its own session, so output streams promptly
+        # and an interrupted run doesn't leave an orphaned transfer running.
         process = subprocess.Popen(
             full_command,
-            shell=True,
             stdout=subprocess.PIPE,
             stderr=subprocess.STDOUT,
-            universal_newlines=True,
+            text=True,
+            bufsize=1,
+            start_new_session=True,
         )
 
-        for line in process.stdout:
-            logger.info(line.strip())
+        try:
+            for line in process.stdout:
+                logger.info(line.strip())
+            process.wait()
+        finally:
+            if process.poll() is None:
+                # Kill the whole group: terminating only gcloud leaves its
+                # ssh child (and the remote transfer) running.
+                try:
+                    os.killpg(process.pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+                process.wait()
 
-        process.wait()
         if process.returncode != 0:
             raise Exception(
                 f"Failed to download from GCS. Return code: {process.returncode}"
@@ -256,10 +405,16 @@ class GCSVMManager:
         Raises:
             Exception: If the command fails.
         """
-        command = f"""
-        gcloud compute instances detach-disk {vm_name} \
-        --disk={disk_name} --zone={self.zone} --project={self.project}
-        """
+        command = [
+            "gcloud",
+            "compute",
+            "instances",
+            "detach-disk",
+            vm_name,
+            f"--disk={disk_name}",
+            f"--zone={self.zone}",
+            f"--project={self.project}",
+        ]
         _, error, rc = self.run_command(command)
         if rc != 0:
             raise Exception(f"Failed to detach disk: {error}")
@@ -275,11 +430,16 @@ class GCSVMManager:
         Raises:
             Exception: If the command fails.
         """
-        command = f"""
-        gcloud compute images create {image_name} \
-        --source-disk={disk_name} --source-disk-zone={self.zone} \
-        --project={self.project}
-        """
+        command = [
+            "gcloud",
+            "compute",
+            "images",
+            "create",
+            image_name,
+            f"--source-disk={disk_name}",
+            f"--source-disk-zone={self.zone}",
+            f"--project={self.project}",
+        ]
         _, error, rc = self.run_command(command)
         if rc != 0:
             raise Exception(f"Failed to create image: {error}")
@@ -310,10 +470,16 @@ class GCSVMManager:
         Raises:
             Exception: If the command fails.
         """
-        command = f"""
-        gcloud compute instances delete {vm_name} \
-        --zone={self.zone} --project={self.project} --quiet
-        """
+        command = [
+            "gcloud",
+            "compute",
+            "instances",
+            "delete",
+            vm_name,
+            f"--zone={self.zone}",
+            f"--project={self.project}",
+            "--quiet",
+        ]
         _, error, rc = self.run_command(command)
         if rc != 0:
             raise Exception(f"Failed to delete VM: {error}")
@@ -328,10 +494,16 @@ class GCSVMManager:
         Raises:
             Exception: If the command fails.
         """
-        command = f"""
-        gcloud compute disks delete {disk_name} \
-        --zone={self.zone} --project={self.project} --quiet
-        """
+        command = [
+            "gcloud",
+            "compute",
+            "disks",
+            "delete",
+            disk_name,
+            f"--zone={self.zone}",
+            f"--project={self.project}",
+            "--quiet",
+        ]
         _, error, rc = self.run_command(command)
         if rc != 0:
             raise Exception(f"Failed to delete disk: {error}")
@@ -343,10 +515,12 @@ def setup_disk(args: argparse.ArgumentParser):
 
     try:
         # Generate default names if not provided
+        user = getpass.getuser()
+        timestamp = int(time.time())
         if not args.vm_name:
-            args.vm_name = f"{os.getlogin()}-temp-vm-{int(time.time())}"
+            args.vm_name = f"{user}-temp-vm-{timestamp}"
         if not args.disk_name:
-            args.disk_name = f"{os.getlogin()}-temp-disk-{int(time.time())}"
+            args.disk_name = f"{user}-temp-disk-{timestamp}"
 
         # Check if the specified args.zone matches the bucket's region
         bucket_region = manager.get_bucket_region(gcs_path=args.gcs_path)
@@ -356,14 +530,14 @@ def setup_disk(args: argparse.ArgumentParser):
                 f"This may incur additional costs and increase transfer time."
             )
 
-        logger.info("Calculating required disk size...")
-        bucket_size = manager.get_bucket_size(gcs_path=args.gcs_path)
-
-        if args.disk_size_gb and int(args.disk_size_gb) < bucket_size:
-            raise ValueError(
-                f"Provided disk size ({args.disk_size_gb}) is less than the esitmated bucket size ({bucket_size})."
-            )
+        if args.disk_size_gb:
+            # Trust the user-provided size and skip the bucket walk, which
+            # can take minutes on large buckets.
+            args.disk_size_gb = int(args.disk_size_gb)
+            logger.info(f"Using provided disk size of {args.disk_size_gb}GB.")
         else:
+            logger.info("Calculating required disk size...")
+            bucket_size = manager.get_bucket_size(gcs_path=args.gcs_path)
             user_confirm = input(
                 f"Estimated required disk size: {bucket_size}GB. Proceed? (y/n): "
             )
@@ -372,11 +546,16 @@ def setup_disk(args: argparse.ArgumentParser):
                 return
             args.disk_size_gb = bucket_size
 
-        logger.info("Creating VM...")
-        manager.create_vm(name=args.vm_name, machine_type=args.machine_type)
-
-        logger.info("Creating disk...")
-        manager.create_disk(name=args.disk_name, size_gb=args.disk_size_gb)
+        logger.info("Creating VM and disk in parallel...")
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            vm_future = executor.submit(
+                manager.create_vm, name=args.vm_name, machine_type=args.machine_type
+            )
+            disk_future = executor.submit(
+                manager.create_disk, name=args.disk_name, size_gb=args.disk_size_gb
+            )
+            vm_future.result()
+            disk_future.result()
 
         logger.info("Attaching disk to VM...")
         manager.attach_disk(vm_name=args.vm_name, disk_name=args.disk_name)
@@ -386,17 +565,34 @@ def setup_disk(args: argparse.ArgumentParser):
             vm_name=args.vm_name, use_google_proxy=args.use_google_proxy
         )
 
+        object_count = manager.get_object_count(gcs_path=args.gcs_path)
+        if object_count is not None and object_count > 10000:
+            logger.warning(
+                f"The path contains over {object_count - 1} objects. Transfers "
+                f"of many small files are dominated by per-object overhead; "
+                f"consider bundling them into archives (e.g. tar) before "
+                f"downloading."
+            )
+
         logger.info("Starting download from GCS...")
         manager.download_from_gcs(
             vm_name=args.vm_name,
             gcs_path=args.gcs_path,
             use_google_proxy=args.use_google_proxy,
         )
-        logger.info("Quick wait to avoid any race conditions...")
-        time.sleep(30)
+        logger.info("Flushing and unmounting disk...")
+        _, error, rc = manager.run_on_vm(
+            args.vm_name,
+            "sudo sync && sudo umount /mnt/disks/persist",
+            use_google_proxy=args.use_google_proxy,
+        )
+        if rc != 0:
+            # Detaching or imaging a still-mounted, un-flushed filesystem
+            # risks a corrupt image, so stop here.
+            raise Exception(f"Failed to flush and unmount disk: {error}")
 
         logger.info("Detaching disk...")
-        # manager.detach_disk(vm_name=args.vm_name, disk_name=args.disk_name)
+        manager.detach_disk(vm_name=args.vm_name, disk_name=args.disk_name)
 
         if args.image_name:
             logger.info(f"Creating image '{args.image_name}' from disk...")
@@ -414,4 +610,5 @@ def setup_disk(args: argparse.ArgumentParser):
         logger.error(f"An error occurred: {str(e)}")
     finally:
         logger.info("Cleaning up resources...")
+        manager.close()
         # manager.delete_vm(vm_name=args.vm_name)
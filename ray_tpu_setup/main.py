@@ -2,17 +2,19 @@
 """CLI for ray-tpu-setup."""
 
 import argparse
+import functools
 import logging
 from .tpu_setup import setup_ray_tpu_cluster
 from .disk_manager import setup_disk
+import shutil
 import sys
-import subprocess
 
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
+@functools.lru_cache(maxsize=1)
 def check_gcloud_installed() -> bool:
     """
     Check if the Google Cloud SDK (gcloud) is installed and accessible.
@@ -21,21 +23,11 @@ def check_gcloud_installed() -> bool:
         bool: True if gcloud is installed and accessible, False otherwise.
     """
     logger.info("Checking if gcloud is installed...")
-    try:
-        subprocess.run(
-            ["gcloud", "--version"],
-            check=True,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-        )
-        logger.info("gcloud is installed and accessible.")
-        return True
-    except subprocess.CalledProcessError:
-        logger.error("gcloud is installed but returned a non-zero exit code.")
-        return False
-    except FileNotFoundError:
+    if shutil.which("gcloud") is None:
         logger.error("gcloud is not found in the system PATH.")
         return False
+    logger.info("gcloud is installed and accessible.")
+    return True
 
 
 def main():
@@ -55,6 +47,12 @@ def main():
     tpu_parser = subparsers.add_parser("setup", help="Set up a Ray cluster on TPU")
     tpu_parser.add_argument("name", help="Unique name used for TPU name and QR ID")
     tpu_parser.add_argument("--dockerfile", help="Path to the Dockerfile")
+    tpu_parser.add_argument(
+        "--docker-image",
+        help="Pre-built image to run instead of building the Dockerfile on "
+        "every worker. Build and push it once (e.g. to Artifact Registry), "
+        "then each worker just pulls it.",
+    )
     tpu_parser.add_argument("--project", required=True, help="GCP project ID")
     tpu_parser.add_argument("--zone", required=True, help="GCP zone")
     tpu_parser.add_argument(
@@ -66,6 +64,12 @@ def main():
         action="store_true",
         help="Use Google corporate proxy for SSH connections",
     )
+    tpu_parser.add_argument(
+        "--staging-bucket",
+        help="GCS bucket used to stage the Dockerfile. Workers download it "
+        "from GCS instead of receiving it embedded in the startup-script "
+        "metadata (which is capped at 256KB).",
+    )
     tpu_parser.add_argument(
         "--image-name",
         required=False,
@@ -1,8 +1,12 @@
 #!/usr/bin/env python3
 """A simple script to create a TPU cluster and start a Ray cluster where worker 0 is the head node."""
 
-from typing import Tuple, List, Optional, Any
+from typing import Tuple, List, Optional, Any, Union
 import argparse
+import json
+import random
+import select
+import signal
 import subprocess
 import shlex
 import time
@@ -13,8 +17,12 @@ import concurrent.futures
 from concurrent.futures import ThreadPoolExecutor
 import tempfile
 import base64
+import glob
+import hashlib
 import re
 
+from . import _shell
+
 
 # Set up logging
 logging.basicConfig(
@@ -22,61 +30,267 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Emitted by the generated startup script when it finishes, so callers can
+# stream syslog and detect completion instead of polling.
+STARTUP_DONE_MARKER = "RAY_TPU_STARTUP_DONE"
+
 
 class TPUPod:
+    _CONTROL_PATH = "/tmp/ray-tpu-cm-%r@%h:%p"
+    # How long a cached describe response stays valid. Long enough to cover
+    # the back-to-back exists/IP/disk lookups in one setup pass, short
+    # enough that state transitions are still observed promptly.
+    _DESCRIBE_TTL = 10.0
+
     def __init__(self, name: str, project: str, zone: str, use_google_proxy: bool):
         self.name = name
         self.project = project
         self.zone = zone
         self.use_google_proxy = use_google_proxy
         self.worker_ips = []
+        self._describe_cache: Optional[Tuple[float, dict]] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        # SSH option fragments are constant per pod; build them once instead
+        # of re-assembling them on every ssh/scp call.
+        self._ssh_mux_argv = [
+            "-o",
+            "ControlMaster=auto",
+            "-o",
+            f"ControlPath={self._CONTROL_PATH}",
+            "-o",
+            "ControlPersist=600s",
+        ]
+        self._scp_mux_argv = [
+            "--scp-flag=-o ControlMaster=auto",
+            f"--scp-flag=-o ControlPath={self._CONTROL_PATH}",
+            "--scp-flag=-o ControlPersist=600s",
+        ]
+        self._proxy_argv = (
+            ["-o", "ProxyCommand=corp-ssh-helper %h %p"] if use_google_proxy else []
+        )
+        self._scp_proxy_argv = (
+            ["--scp-flag=-o ProxyCommand=/usr/bin/corp-ssh-helper %h %p"]
+            if use_google_proxy
+            else []
+        )
 
-    def run_command(self, command: str, timeout: int = 60) -> Tuple[str, str, int]:
-        logger.info(f"Running command: {command}")
-        try:
-            result = subprocess.run(
-                shlex.split(command), capture_output=True, text=True, timeout=timeout
-            )
-            return result.stdout, result.stderr, result.returncode
-        except subprocess.TimeoutExpired:
-            return "", "Command timed out", 1
+    def _get_executor(self) -> ThreadPoolExecutor:
+        """Lazily create one thread pool shared by all setup phases.
+
+        Threads are spawned on demand up to the cap, so a small pod doesn't
+        pay for 64 threads; reusing one pool avoids tearing threads down
+        between the disk, per-worker setup, and ray-start phases.
+        """
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=64)
+        return self._executor
+
+    def _describe(self, force: bool = False) -> Optional[dict]:
+        """Describe the pod, caching the parsed JSON for a short TTL.
+
+        Each gcloud invocation costs ~1s of CLI startup alone, and several
+        methods only need different fields of the same describe response.
+        Returns None if the pod does not exist (or describe failed).
+        """
+        if not force and self._describe_cache:
+            cached_at, data = self._describe_cache
+            if time.monotonic() - cached_at < self._DESCRIBE_TTL:
+                return data
+        command = [
+            "gcloud",
+            "compute",
+            "tpus",
+            "tpu-vm",
+            "describe",
+            self.name,
+            f"--zone={self.zone}",
+            f"--project={self.project}",
+            "--format=json",
+        ]
+        output, _, returncode = self.run_command(command)
+        if returncode != 0:
+            self._describe_cache = None
+            return None
+        data = json.loads(output)
+        self._describe_cache = (time.monotonic(), data)
+        return data
+
+    def run_command(
+        self,
+        command: "Union[str, List[str]]",
+        timeout: int = 60,
+        stream: bool = False,
+    ) -> Tuple[str, str, int]:
+        return _shell.run_command(command, timeout, stream=stream)
 
     def ssh_command(
-        self, worker: int, command: str, timeout: int = 60
+        self, worker: Any, command: str, timeout: int = 60, stream: bool = False
     ) -> Tuple[str, str, int]:
-        proxy_command = (
-            " -- -o ProxyCommand='corp-ssh-helper %h %p'"
-            if self.use_google_proxy
-            else ""
+        return self.run_command(
+            self.ssh_command_argv(worker, command), timeout, stream=stream
         )
-        full_command = f"gcloud compute tpus tpu-vm ssh {self.name} --worker={worker} --zone={self.zone} --project={self.project} --command='{command}'{proxy_command}"
-        return self.run_command(full_command, timeout)
+
+    def ssh_command_argv(self, worker: Any, command: str) -> List[str]:
+        # Build argv directly: the remote command travels as one argument,
+        # so it never round-trips through local shell quoting (embedded
+        # quotes in commands used to break the old f-string form).
+        # Multiplex connections per worker so repeat commands skip the SSH
+        # handshake; with --use-google-proxy this also avoids re-running
+        # corp-ssh-helper authentication for every command.
+        argv = [
+            "gcloud",
+            "compute",
+            "tpus",
+            "tpu-vm",
+            "ssh",
+            self.name,
+            f"--worker={worker}",
+            f"--zone={self.zone}",
+            f"--project={self.project}",
+            f"--command={command}",
+            "--",
+        ]
+        return argv + self._ssh_mux_argv + self._proxy_argv
+
+    def close(self) -> None:
+        """Shut down the shared executor and close any SSH control sockets."""
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        for socket_path in glob.glob("/tmp/ray-tpu-cm-*"):
+            subprocess.run(
+                ["ssh", "-O", "exit", "-o", f"ControlPath={socket_path}", "unused"],
+                capture_output=True,
+            )
+
+    def ssh_all(self, command: str, timeout: int = 60) -> Tuple[str, str, int]:
+        """Run a command on every worker with one gcloud invocation.
+
+        gcloud fans the command out to all workers in parallel server-side,
+        avoiding one SSH handshake and gcloud startup per worker.
+        """
+        return self.ssh_command("all", command, timeout)
 
     def exists(self) -> bool:
-        command = f"gcloud compute tpus tpu-vm describe {self.name} --project={self.project} --zone={self.zone}"
-        _, _, returncode = self.run_command(command)
-        return returncode == 0
+        return self._describe() is not None
 
     def get_worker_ips(self) -> List[str]:
         if self.worker_ips:
             return self.worker_ips
-        command = f"gcloud compute tpus tpu-vm describe {self.name} --zone={self.zone} --project={self.project} --format='get(networkEndpoints[].ipAddress)'"
-        output, err, returncode = self.run_command(command)
-        if returncode != 0:
-            logger.error(f"Error getting worker IPs ({err})")
+        data = self._describe()
+        if data is None:
+            logger.error("Error getting worker IPs")
             return []
-        self.worker_ips = output.strip().split(";")
+        self.worker_ips = [
+            endpoint["ipAddress"]
+            for endpoint in data.get("networkEndpoints", [])
+            if "ipAddress" in endpoint
+        ]
         return self.worker_ips
 
-    def wait_until_ready(self):
+    def get_head_ip(self) -> Optional[str]:
+        """Return worker 0's IP (the Ray head), without an extra describe.
+
+        Served from the worker-IP cache, which itself is seeded by the
+        shared describe cache or the readiness poll.
+        """
+        worker_ips = self.get_worker_ips()
+        return worker_ips[0] if worker_ips else None
+
+    def wait_until_ready(self, timeout: int = 1800):
+        """Poll until the pod reports READY, or raise TimeoutError."""
+        delay = 4.0
+        last_state = None
+        deadline = time.monotonic() + timeout
         while True:
-            command = f"gcloud compute tpus tpu-vm describe {self.name} --zone={self.zone} --project={self.project}"
-            output, _, _ = self.run_command(command)
-            if "state: READY" in output:
-                logger.info("TPU is ready")
-                break
-            logger.info("Waiting for TPU to be ready...")
-            time.sleep(30)
+            # Force a fresh describe: a cached state would just stretch the
+            # wait, and each poll refreshes the cache for later readers.
+            data = self._describe(force=True)
+            state = None
+            if data is not None:
+                state = data.get("state")
+                if state == "READY":
+                    # The describe already delivered the worker IPs, so cache
+                    # them and spare get_worker_ips a second round-trip.
+                    self.worker_ips = [
+                        endpoint["ipAddress"]
+                        for endpoint in data.get("networkEndpoints", [])
+                        if "ipAddress" in endpoint
+                    ]
+                    logger.info("TPU is ready")
+                    break
+            if state != last_state:
+                # A state transition tends to be followed by another one
+                # soon; poll quickly again to confirm it.
+                delay = 4.0
+                last_state = state
+            if time.monotonic() >= deadline:
+                raise TimeoutError(
+                    f"TPU pod '{self.name}' not ready after {timeout}s "
+                    f"(last state: {state})"
+                )
+            logger.info(f"Waiting for TPU to be ready (state: {state})...")
+            # Jitter so concurrent setups don't synchronize their polls.
+            time.sleep(delay * random.uniform(0.8, 1.2))
+            delay = min(30.0, delay * 1.5)
+
+    def wait_for_startup_script(self, worker: int = 0, timeout: int = 600) -> bool:
+        """Stream startup-script output from a worker until it completes.
+
+        Holds one long-lived SSH session tailing syslog instead of polling
+        with repeated connections, and returns as soon as the completion
+        marker appears.
+        """
+        logger.info(f"Waiting for the startup script to finish on worker {worker}")
+        tail_command = (
+            "sudo tail -n +1 -F /var/log/syslog | grep --line-buffered startup-script"
+        )
+        argv = self.ssh_command_argv(worker, tail_command)
+        logger.info(f"Running command: {shlex.join(argv)}")
+        # Own session so cleanup can kill the whole tree: terminating only
+        # gcloud would leave its ssh child (and the remote tail) running.
+        process = subprocess.Popen(
+            argv,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            start_new_session=True,
+        )
+        # Read the raw fd: selecting on a buffered text stream deadlocks if
+        # a readline pulls the marker into the Python-side buffer, because
+        # tail -F never closes the pipe and select never fires again.
+        fd = process.stdout.fileno()
+        pending = b""
+        deadline = time.monotonic() + timeout
+        try:
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    logger.error("Timed out waiting for the startup script")
+                    return False
+                # Guard the blocking read so a silent stream still honors
+                # the deadline.
+                readable, _, _ = select.select([fd], [], [], min(remaining, 10))
+                if not readable:
+                    continue
+                chunk = os.read(fd, 4096)
+                if not chunk:
+                    logger.error(
+                        "Startup log stream ended before the completion marker"
+                    )
+                    return False
+                *lines, pending = (pending + chunk).split(b"\n")
+                for raw_line in lines:
+                    line = raw_line.decode(errors="replace")
+                    logger.info(line.strip())
+                    if STARTUP_DONE_MARKER in line:
+                        logger.info(f"Startup script finished on worker {worker}")
+                        return True
+        finally:
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            process.wait()
 
     def create(
         self,
@@ -84,82 +298,209 @@ class TPUPod:
         version: str,
         dockerfile: Optional[str] = None,
         disk_name: Optional[str] = None,
+        docker_image: Optional[str] = None,
+        dockerfile_gcs_path: Optional[str] = None,
     ) -> bool:
-        command = f"gcloud compute tpus tpu-vm create {self.name} --accelerator-type={accelerator_type} --version={version} --zone={self.zone} --project={self.project}"
-        if dockerfile:
-            startup_script = create_startup_script(dockerfile, disk_name)
-            command += f" --metadata-from-file='startup-script={startup_script}'"
+        command = [
+            "gcloud",
+            "compute",
+            "tpus",
+            "tpu-vm",
+            "create",
+            self.name,
+            f"--accelerator-type={accelerator_type}",
+            f"--version={version}",
+            f"--zone={self.zone}",
+            f"--project={self.project}",
+        ]
+        # Always attach a startup script: in docker mode it builds and runs
+        # the container, otherwise it installs Ray — either way the work
+        # happens on every worker in parallel during boot, so the setup
+        # phase doesn't have to push it over SSH afterwards.
+        script_content = create_startup_script(
+            dockerfile, disk_name, docker_image, dockerfile_gcs_path
+        )
+        script_path = write_startup_script(script_content)
+        command.append(f"--metadata-from-file=startup-script={script_path}")
         if disk_name:
-            command += f" --data-disk source=projects/{self.project}/zones/{self.zone}/disks/{disk_name},mode=read-only"
-        _, error, returncode = self.run_command(command)
+            command += [
+                "--data-disk",
+                f"source=projects/{self.project}/zones/{self.zone}/disks/{disk_name},mode=read-only",
+            ]
+        # The create blocks until the pod is provisioned, which takes
+        # minutes — far beyond the default 60s command timeout.
+        _, error, returncode = self.run_command(command, timeout=1800)
         if returncode != 0:
             logger.error(f"Error creating TPU pod: {error}")
             return False
         logger.info(f"TPU pod '{self.name}' created successfully")
         return True
 
-    def setup_ray(self, dockerfile: Optional[str] = None) -> bool:
-        worker_ips = self.get_worker_ips()
-        worker_count = len(worker_ips)
-
-        if not dockerfile:
-            logger.info("Installing Ray on all workers")
-            with ThreadPoolExecutor(max_workers=worker_count) as executor:
-                results = list(executor.map(self.install_ray, range(worker_count)))
-            if not all(results):
-                logger.error("Failed to install Ray on all workers")
-                return False
-
-        logger.info("Starting Ray on the head node (worker 0)")
-        if not self.start_ray_on_worker(
-            0, worker_ips[0], is_head_node=True, dockerfile=dockerfile
-        ):
-            logger.error("Failed to start Ray on the head node")
+    def ray_cluster_is_healthy(
+        self, worker_count: int, dockerfile: Optional[str]
+    ) -> bool:
+        """Check whether a Ray cluster with every worker attached is already up."""
+        ray_command = (
+            "sudo docker exec ray_container ray "
+            if dockerfile
+            else 'PATH="$PATH:$HOME/.local/bin" ray '
+        )
+        output, _, returncode = self.ssh_command(
+            0, f"{ray_command}status --address=127.0.0.1:6379", timeout=15
+        )
+        if returncode != 0:
             return False
+        # `ray status` lists one "1 node_<id>" line per active node.
+        return output.count("node_") == worker_count
 
-        if worker_count > 1:
-            logger.info("Starting Ray on other workers")
-            with ThreadPoolExecutor(max_workers=worker_count - 1) as executor:
-                results = list(
-                    executor.map(
-                        lambda w: self.start_ray_on_worker(
-                            w, worker_ips[0], is_head_node=False, dockerfile=dockerfile
-                        ),
-                        range(1, worker_count),
-                    )
-                )
-            if not all(results):
-                logger.error("Failed to start Ray on all workers")
-                return False
+    def setup_ray(
+        self, dockerfile: Optional[str] = None, ray_installed: bool = False
+    ) -> bool:
+        worker_count = len(self.get_worker_ips())
+        head_ip = self.get_head_ip()
 
-        logger.info("Ray cluster setup completed successfully")
-        return True
+        if self.ray_cluster_is_healthy(worker_count, dockerfile):
+            logger.info("Ray cluster is already running on all workers")
+            return True
 
-    def install_ray(self, worker: int) -> bool:
-        logger.info(f"Installing Ray on worker {worker}")
-        _, error, returncode = self.ssh_command(worker, "pip install 'ray[default]'")
-        if returncode != 0:
-            logger.error(f"Error installing Ray on worker {worker}: {error}")
+        # Folding the install into the start command means each worker pays
+        # one SSH session for both instead of a separate install broadcast.
+        install_first = not dockerfile and not ray_installed
+        timeout = 600 if install_first else 120
+
+        # Start the head and the worker broadcast concurrently: the workers'
+        # `ray start --address=...` retries until the head is reachable, so
+        # there is no need to serialize behind the head's SSH round-trip.
+        logger.info("Starting Ray on the head node and workers")
+        executor = self._get_executor()
+        head_future = executor.submit(
+            self.start_ray_on_worker,
+            0,
+            head_ip,
+            is_head_node=True,
+            dockerfile=dockerfile,
+            install_first=install_first,
+            timeout=timeout,
+        )
+        join_future = None
+        if worker_count > 1:
+            join_command = self.ray_start_command(
+                head_ip,
+                is_head_node=False,
+                dockerfile=dockerfile,
+                install_first=install_first,
+            )
+            # Broadcast to every worker at once; the guard skips the head
+            # node (worker hostnames end in the worker index).
+            guarded_command = (
+                f'if [ "${{HOSTNAME##*-}}" != "0" ]; then {join_command}; fi'
+            )
+            join_future = executor.submit(
+                self.join_workers_with_retry, guarded_command, timeout=timeout
+            )
+        head_ok = head_future.result()
+        join_ok = join_future.result() if join_future else True
+
+        if not head_ok:
+            logger.error("Failed to start Ray on the head node")
+            return False
+        if not join_ok:
+            logger.error("Failed to start Ray on all workers")
             return False
+
+        logger.info("Ray cluster setup completed successfully")
         return True
 
-    def start_ray_on_worker(
-        self, worker: int, head_ip: str, is_head_node: bool, dockerfile: Optional[str]
+    def join_workers_with_retry(
+        self, guarded_command: str, attempts: int = 5, timeout: int = 300
     ) -> bool:
-        logger.info(f"Starting Ray on worker {worker}")
+        """Broadcast the worker join command, retrying while the head comes up."""
+        for attempt in range(attempts):
+            _, error, returncode = self.ssh_all(guarded_command, timeout=timeout)
+            if returncode == 0:
+                return True
+            logger.warning(
+                f"Worker join attempt {attempt + 1}/{attempts} failed: {error}"
+            )
+            time.sleep(5)
+        return False
+
+    def ray_start_command(
+        self,
+        head_ip: str,
+        is_head_node: bool,
+        dockerfile: Optional[str],
+        install_first: bool = False,
+    ) -> str:
+        # Without OMP_NUM_THREADS, `import ray` spawns one OpenMP thread per
+        # vCPU on worker start, which adds seconds on many-core TPU hosts.
         ray_command = (
-            "sudo docker exec ray_container ray "
+            "sudo docker exec -e OMP_NUM_THREADS=1 ray_container ray "
             if dockerfile
-            else "/home/$(whoami)/.local/bin/ray "
+            else 'OMP_NUM_THREADS=1 PATH="$PATH:$HOME/.local/bin" ray '
         )
         ray_command += (
             "start --head --port=6379"
             if is_head_node
             else f"start --address={head_ip}:6379"
         )
-        _, error, returncode = self.ssh_command(worker, ray_command)
+        if dockerfile:
+            # Same idempotency guard as the non-docker branch, inside the
+            # container: without it, workers that already joined make every
+            # retry broadcast fail and the retries can never converge. Wait
+            # for the readiness marker touched once the container is running
+            # (by the startup script or by build_and_run_docker) before
+            # exec'ing into it.
+            ray_command = (
+                "until test -f /tmp/ray_container_ready; do sleep 2; done; "
+                "sudo docker exec ray_container pgrep -x raylet >/dev/null || "
+                + ray_command
+            )
+        else:
+            # Make re-runs and join retries cheap: skip the start entirely
+            # when a raylet is already running on the worker. -x matches the
+            # process name exactly; -f would match this command's own shell,
+            # whose argv contains "raylet", and always skip the start.
+            ray_command = f"pgrep -x raylet >/dev/null || {ray_command}"
+            if not install_first:
+                # Ray came from the boot startup script; wait for its marker
+                # (the analog of /tmp/ray_container_ready) so the broadcast
+                # doesn't race workers still mid-install.
+                ray_command = (
+                    "until test -f /tmp/ray_env_ready; do sleep 2; done; "
+                    + ray_command
+                )
+        if install_first:
+            # One SSH session covers install + start, and the install is
+            # skipped when Ray is already on the PATH (pip takes 5-15s just
+            # to confirm a no-op).
+            ray_command = (
+                'PATH="$PATH:$HOME/.local/bin" command -v ray >/dev/null 2>&1 '
+                "|| pip install 'ray[default]'; " + ray_command
+            )
+        return ray_command
+
+    def start_ray_on_worker(
+        self,
+        worker: int,
+        head_ip: str,
+        is_head_node: bool,
+        dockerfile: Optional[str],
+        install_first: bool = False,
+        timeout: int = 120,
+    ) -> bool:
+        logger.info(f"Starting Ray on worker {worker}")
+        ray_command = self.ray_start_command(
+            head_ip, is_head_node, dockerfile, install_first
+        )
+        # Stream when the command includes the pip install; its log is large.
+        output, error, returncode = self.ssh_command(
+            worker, ray_command, timeout=timeout, stream=install_first
+        )
         if returncode != 0:
-            logger.error(f"Error starting Ray on worker {worker}: {error}")
+            logger.error(
+                f"Error starting Ray on worker {worker}: {error or output}"
+            )
             return False
         return True
 
@@ -169,32 +510,48 @@ class TPUPod:
         )
 
         # Check if disk is already attached
-        describe_command = f"gcloud compute tpus tpu-vm describe {self.name} --project={self.project} --zone={self.zone} --format='value(dataDisks)'"
-        output, error, returncode = self.run_command(describe_command)
-
-        if returncode != 0:
-            logger.error(f"Error checking disk attachment: {error}")
+        data = self._describe()
+        if data is None:
+            logger.error("Error checking disk attachment")
             return False
 
-        if disk_name in output:
+        attached = [disk.get("sourceDisk", "") for disk in data.get("dataDisks", [])]
+        if any(disk_name in source for source in attached):
             logger.info(
                 f"Disk '{disk_name}' is already attached to TPU pod '{self.name}'"
             )
             return True
 
         logger.info(f"Attaching disk '{disk_name}' to TPU pod '{self.name}'")
-        command = f"gcloud alpha compute tpus tpu-vm attach-disk {self.name} --disk {disk_name} --mode read-only --project {self.project} --zone {self.zone}"
+        command = [
+            "gcloud",
+            "alpha",
+            "compute",
+            "tpus",
+            "tpu-vm",
+            "attach-disk",
+            self.name,
+            f"--disk={disk_name}",
+            "--mode=read-only",
+            f"--project={self.project}",
+            f"--zone={self.zone}",
+        ]
         _, error, returncode = self.run_command(command)
         if returncode != 0:
             logger.error(f"Error attaching disk: {error}")
             return False
+        # The cached describe no longer reflects the pod's disks.
+        self._describe_cache = None
         logger.info(
             f"Disk '{disk_name}' attached successfully to TPU pod '{self.name}'"
         )
         return True
 
     def setup_existing_pod(
-        self, dockerfile: Optional[str] = None, disk_name: Optional[str] = None
+        self,
+        dockerfile: Optional[str] = None,
+        disk_name: Optional[str] = None,
+        docker_image: Optional[str] = None,
     ) -> bool:
         logger.info(f"Setting up existing TPU pod '{self.name}'")
 
@@ -202,24 +559,42 @@ class TPUPod:
             if not self.attach_disk(disk_name):
                 return False
 
+        # Push the Dockerfile to every worker with one scp broadcast up
+        # front, so the per-worker threads only build and run.
+        if dockerfile:
+            if not self.transfer_file_all(dockerfile, "~/Dockerfile"):
+                return False
+
         worker_count = len(self.get_worker_ips())
 
-        with ThreadPoolExecutor(max_workers=worker_count) as executor:
-            future_to_worker = {
-                executor.submit(self.setup_worker, w, dockerfile, disk_name): w
-                for w in range(worker_count)
-            }
-
-            for future in concurrent.futures.as_completed(future_to_worker):
-                worker = future_to_worker[future]
-                try:
-                    success = future.result()
-                    if not success:
-                        logger.error(f"Failed to set up worker {worker}")
-                        return False
-                except Exception as exc:
-                    logger.error(f"Worker {worker} generated an exception: {exc}")
-                    return False
+        executor = self._get_executor()
+        future_to_worker = {
+            executor.submit(
+                self.setup_worker, w, dockerfile, disk_name, docker_image
+            ): w
+            for w in range(worker_count)
+        }
+
+        for future in concurrent.futures.as_completed(future_to_worker):
+            worker = future_to_worker[future]
+            try:
+                success = future.result()
+                if not success:
+                    logger.error(f"Failed to set up worker {worker}")
+            except Exception as exc:
+                logger.error(f"Worker {worker} generated an exception: {exc}")
+                success = False
+            if not success:
+                # Don't let queued workers start minutes of doomed setup
+                # (e.g. building a broken Dockerfile); running ones finish.
+                cancelled = sorted(
+                    w for f, w in future_to_worker.items() if f.cancel()
+                )
+                if cancelled:
+                    logger.info(
+                        f"Cancelled setup for not-yet-started workers: {cancelled}"
+                    )
+                return False
 
         logger.info("All workers set up successfully")
         return True
@@ -227,14 +602,17 @@ class TPUPod:
     def transfer_file(self, local_path: str, worker: int, remote_path: str) -> bool:
         logger.info(f"Transferring file to worker {worker}")
 
-        filename = os.path.basename(local_path)
-        proxy_flag = (
-            '--scp-flag="-o ProxyCommand=/usr/bin/corp-ssh-helper %h %p"'
-            if self.use_google_proxy
-            else ""
-        )
-
-        command = f"gcloud compute tpus tpu-vm scp {proxy_flag} {filename} {self.name}:{remote_path} --worker={worker} --zone={self.zone} --project={self.project}"
+        # Reuse the control sockets opened by ssh_command so the copy skips
+        # the SSH handshake when a session to the worker already exists.
+        command = ["gcloud", "compute", "tpus", "tpu-vm", "scp"]
+        command += self._scp_mux_argv + self._scp_proxy_argv
+        command += [
+            local_path,
+            f"{self.name}:{remote_path}",
+            f"--worker={worker}",
+            f"--zone={self.zone}",
+            f"--project={self.project}",
+        ]
 
         _, error, returncode = self.run_command(command)
 
@@ -245,8 +623,43 @@ class TPUPod:
         logger.info(f"File transferred successfully to worker {worker}")
         return True
 
+    def transfer_file_all(self, local_path: str, remote_path: str) -> bool:
+        """Copy a file to every worker with a single scp broadcast.
+
+        Like ssh_all, gcloud fans the copy out server-side, replacing one
+        gcloud + SSH handshake per worker with a single invocation.
+        """
+        logger.info("Transferring file to all workers")
+
+        command = [
+            "gcloud",
+            "compute",
+            "tpus",
+            "tpu-vm",
+            "scp",
+            local_path,
+            f"{self.name}:{remote_path}",
+            "--worker=all",
+            f"--zone={self.zone}",
+            f"--project={self.project}",
+        ]
+        command += self._scp_proxy_argv
+
+        _, error, returncode = self.run_command(command, timeout=300)
+
+        if returncode != 0:
+            logger.error(f"Error transferring file to workers: {error}")
+            return False
+
+        logger.info("File transferred successfully to all workers")
+        return True
+
     def setup_worker(
-        self, worker: int, dockerfile: Optional[str], disk_name: Optional[str]
+        self,
+        worker: int,
+        dockerfile: Optional[str],
+        disk_name: Optional[str],
+        docker_image: Optional[str] = None,
     ) -> bool:
         logger.info(f"Setting up worker {worker}")
 
@@ -255,8 +668,12 @@ class TPUPod:
             if not self.mount_disk(worker, disk_name):
                 return False
 
-        # Handle Dockerfile if specified
-        if dockerfile:
+        # A pre-built image takes precedence over building the Dockerfile
+        # locally on every worker.
+        if docker_image:
+            if not self.pull_and_run_docker(worker, docker_image, disk_name):
+                return False
+        elif dockerfile:
             if not self.build_and_run_docker(worker, dockerfile, disk_name):
                 return False
 
@@ -278,11 +695,11 @@ class TPUPod:
             "sudo mount -o ro,noload /dev/sdb /mnt/disks/persist",
         ]
 
-        for command in mount_commands:
-            _, error, returncode = self.ssh_command(worker, command)
-            if returncode != 0:
-                logger.error(f"Error mounting disk on worker {worker}: {error}")
-                return False
+        # One SSH round-trip for the whole sequence; && still fails fast.
+        _, error, returncode = self.ssh_command(worker, " && ".join(mount_commands))
+        if returncode != 0:
+            logger.error(f"Error mounting disk on worker {worker}: {error}")
+            return False
 
         logger.info(f"Disk '{disk_name}' mounted successfully on worker {worker}")
         return True
@@ -292,24 +709,26 @@ class TPUPod:
     ) -> bool:
         logger.info(f"Building and running Docker container on worker {worker}")
 
-        # Transfer Dockerfile
-        if not self.transfer_file(dockerfile_path, worker, "~/Dockerfile"):
-            logger.warning(f"Failed to transfer Dockerfile for worker {worker}.")
-            return False
+        # The Dockerfile was already broadcast to ~/Dockerfile on every
+        # worker by transfer_file_all in setup_existing_pod.
 
         # Build Docker image
         build_cmd = "sudo docker build -t ray_image -f ~/Dockerfile ."
-        # Timeout after 5 min
-        _, error, returncode = self.ssh_command(worker, build_cmd, timeout=300)
+        # Timeout after 5 min; stream the build log instead of buffering it.
+        output, error, returncode = self.ssh_command(
+            worker, build_cmd, timeout=300, stream=True
+        )
         if returncode != 0:
-            logger.error(f"Error building Docker image on worker {worker}: {error}")
+            logger.error(
+                f"Error building Docker image on worker {worker}: {error or output}"
+            )
             return False
 
         # Run Docker container
         run_cmd = "sudo docker run -d --privileged --name ray_container --network host"
         if disk_name:
             run_cmd += " -v /mnt/disks/persist:/mnt/disks/persist"
-        run_cmd += " ray_image"
+        run_cmd += " ray_image && touch /tmp/ray_container_ready"
 
         _, error, returncode = self.ssh_command(worker, run_cmd)
         if returncode != 0:
@@ -321,12 +740,69 @@ class TPUPod:
         )
         return True
 
+    def pull_and_run_docker(
+        self, worker: int, docker_image: str, disk_name: Optional[str] = None
+    ) -> bool:
+        """Pull a pre-built image and run it, skipping the per-worker build."""
+        logger.info(f"Pulling and running Docker container on worker {worker}")
+
+        run_cmd = "sudo docker run -d --privileged --name ray_container --network host"
+        if disk_name:
+            run_cmd += " -v /mnt/disks/persist:/mnt/disks/persist"
+        run_cmd += f" {docker_image} && touch /tmp/ray_container_ready"
+
+        # Timeout after 5 min; the pull dominates and depends on image size.
+        output, error, returncode = self.ssh_command(
+            worker,
+            f"sudo docker pull {docker_image} && {run_cmd}",
+            timeout=300,
+            stream=True,
+        )
+        if returncode != 0:
+            logger.error(
+                f"Error running Docker container on worker {worker}: {error or output}"
+            )
+            return False
+
+        logger.info(f"Docker container running successfully on worker {worker}")
+        return True
+
+
+def upload_dockerfile_to_gcs(dockerfile_path: str, bucket: str) -> Optional[str]:
+    """Upload the Dockerfile to GCS once and return its gs:// URL.
+
+    The object name is content-addressed, so repeated launches with the same
+    Dockerfile skip nothing locally but overwrite an identical object; the
+    workers then pull it from GCS instead of receiving an embedded copy via
+    the instance metadata (which is capped at 256KB per value).
+    """
+    with open(dockerfile_path, "rb") as f:
+        content_hash = hashlib.sha256(f.read()).hexdigest()[:16]
+    gcs_path = f"gs://{bucket}/ray-tpu-setup/Dockerfile-{content_hash}"
+    _, error, returncode = _shell.run_command(
+        ["gcloud", "storage", "cp", dockerfile_path, gcs_path], timeout=120
+    )
+    if returncode != 0:
+        logger.warning(f"Failed to stage Dockerfile to GCS: {error}")
+        return None
+    logger.info(f"Staged Dockerfile at {gcs_path}")
+    return gcs_path
+
 
 def create_startup_script(
-    dockerfile: Optional[str] = None, disk_name: Optional[str] = None
+    dockerfile: Optional[str] = None,
+    disk_name: Optional[str] = None,
+    docker_image: Optional[str] = None,
+    dockerfile_gcs_path: Optional[str] = None,
 ) -> str:
-    script_content = """
-#!/bin/bash
+    # Accumulate parts and join once at the end; repeated += on strings
+    # recopies the whole script for every section with a large Dockerfile.
+    use_docker = bool(docker_image or dockerfile or dockerfile_gcs_path)
+    parts = ["#!/bin/bash\n"]
+    if use_docker:
+        # The apt/docker/credential-helper preamble costs 1-2 minutes of
+        # boot; only pay it when a container is actually going to run.
+        parts.append("""
 sudo sed -i 's/#$nrconf{restart} = '"'"'i'"'"';/$nrconf{restart} = '"'"'a'"'"';/g' /etc/needrestart/needrestart.conf
 if ! command -v docker &> /dev/null; then
     sudo apt-get update
@@ -335,56 +811,78 @@ if ! command -v docker &> /dev/null; then
 fi
 curl -fsSL "https://github.com/GoogleCloudPlatform/docker-credential-gcr/releases/download/v2.1.10/docker-credential-gcr_linux_amd64-2.1.10.tar.gz" | tar xz docker-credential-gcr && chmod +x docker-credential-gcr && sudo mv docker-credential-gcr /usr/bin/
 docker-credential-gcr configure-docker
-    """
+    """)
     if disk_name:
-        script_content += """
+        parts.append("""
 sudo mkdir -p /mnt/disks/persist
 sudo mount -o ro,noload /dev/sdb /mnt/disks/persist
 sudo chmod a+r /mnt/disks/persist
-        """
-    if dockerfile:
-        script_content += f"""
+        """)
+    if docker_image:
+        # Pre-built image: every worker pulls from the registry instead of
+        # running the same build N times.
+        parts.append(f"docker pull {docker_image}\n")
+    elif dockerfile_gcs_path:
+        # Staged Dockerfile: fetch from GCS rather than carrying the full
+        # content inline in the metadata payload.
+        parts.append(
+            f"gcloud storage cp {dockerfile_gcs_path} /tmp/Dockerfile\n"
+            "docker build -t ray_image -f /tmp/Dockerfile .\n"
+        )
+    elif dockerfile:
+        parts.append(f"""
 cat << 'EEOF' > /tmp/Dockerfile
 {dockerfile.strip()}
 EEOF
 docker build -t ray_image -f /tmp/Dockerfile .
-        """
-
+        """)
+    if use_docker:
         docker_run_command = "docker run -d"
         if disk_name:
             docker_run_command += " -v /mnt/disks/persist:/mnt/disks/persist"
         docker_run_command += (
-            " --privileged --name ray_container --network host ray_image"
+            " --privileged --name ray_container --network host "
+            f"{docker_image or 'ray_image'}"
         )
 
-        script_content += docker_run_command + "\n"
+        # Signal container readiness so workers can gate on a cheap file
+        # check instead of probing docker over SSH.
+        parts.append(docker_run_command + " && touch /tmp/ray_container_ready\n")
     else:
-        script_content += "pip install 'ray[default]'"
-    return script_content
+        # Same readiness pattern as the docker path: the join broadcast
+        # waits on this marker rather than racing workers still mid-install.
+        parts.append("pip install 'ray[default]' && touch /tmp/ray_env_ready\n")
+    parts.append(f'echo "{STARTUP_DONE_MARKER}"\n')
+    return "".join(parts)
 
 
-def disk_exists(disk_name: str, project: str, zone: str) -> bool:
-    """Check if a disk with the given name exists in the specified project and zone."""
-    command = (
-        f"gcloud compute disks describe {disk_name} --project={project} --zone={zone}"
-    )
-    process = subprocess.run(command.split(), capture_output=True, text=True)
-    return process.returncode == 0
+def write_startup_script(script_content: str) -> str:
+    """Write the startup script to a content-addressed temp file and return its path.
+
+    The file name includes a hash of the content, so repeated launches with an
+    identical script reuse the existing file instead of rewriting it.
+    """
+    script_hash = hashlib.sha256(script_content.encode()).hexdigest()[:16]
+    script_path = os.path.join(tempfile.gettempdir(), f"tpu_startup_{script_hash}.sh")
+    if not os.path.exists(script_path):
+        with open(script_path, "w") as f:
+            f.write(script_content)
+    return script_path
 
 
 def create_disk_from_image(
     disk_name: str, image_name: str, project: str, zone: str
 ) -> bool:
-    if disk_exists(disk_name, project, zone):
-        logger.info(f"Disk '{disk_name}' already exists. Skipping disk creation.")
-        return True
-    else:
-        logger.info(f"Disk '{disk_name}' does not exist. Creating now...")
-
+    # Issue the create directly instead of describe-then-create: that costs
+    # an extra API round-trip and races anyone else creating the same disk.
+    logger.info(f"Creating disk '{disk_name}' from image '{image_name}'...")
     command = f"gcloud compute disks create {disk_name} --project={project} --zone={zone} --image={image_name} --type pd-balanced"
     process = subprocess.run(command.split(), capture_output=True, text=True)
 
     if process.returncode != 0:
+        if "already exists" in process.stderr.lower():
+            logger.info(f"Disk '{disk_name}' already exists. Skipping disk creation.")
+            return True
         logger.error(f"Error creating disk: {process.stderr}")
         return False
 
@@ -399,35 +897,100 @@ def setup_ray_tpu_cluster(args: argparse.Namespace):
     if args.dockerfile:
         with open(args.dockerfile, "r") as f:
             dockerfile_content = f.read()
+    docker_image = getattr(args, "docker_image", None)
 
+    # Disk creation from an image takes tens of seconds and is independent
+    # of the TPU describe/ready checks, so run it in the background and only
+    # join right before the disk is attached.
+    disk_future = None
     if args.image_name:
         if not args.disk_name:
             args.disk_name = args.name
-        if not create_disk_from_image(
-            args.disk_name, args.image_name, args.project, args.zone
-        ):
-            logger.error(
-                f"Failed to create disk '{args.disk_name}' from image '{args.image_name}'"
-            )
-            return
+        disk_future = tpu_pod._get_executor().submit(
+            create_disk_from_image,
+            args.disk_name,
+            args.image_name,
+            args.project,
+            args.zone,
+        )
+
+    try:
+        _setup_ray_tpu_cluster(
+            tpu_pod, args, dockerfile_content, docker_image, disk_future
+        )
+    finally:
+        # Tear down the executor and the multiplexed SSH control sockets
+        # left behind by ControlPersist so they don't accumulate in /tmp.
+        tpu_pod.close()
+
 
+def _disk_ready(disk_future, args: argparse.Namespace) -> bool:
+    """Join the background disk creation, if one was started."""
+    if disk_future is None:
+        return True
+    if disk_future.result():
+        return True
+    logger.error(
+        f"Failed to create disk '{args.disk_name}' from image '{args.image_name}'"
+    )
+    return False
+
+
+def _setup_ray_tpu_cluster(
+    tpu_pod: "TPUPod",
+    args: argparse.Namespace,
+    dockerfile_content: Optional[str],
+    docker_image: Optional[str],
+    disk_future=None,
+):
     if tpu_pod.exists():
         logger.info(f"TPU pod '{args.name}' already exists. Setting up existing pod.")
         tpu_pod.wait_until_ready()
+        # The disk is first needed by attach_disk inside setup_existing_pod.
+        if not _disk_ready(disk_future, args):
+            return
         # Generate and run the startup script for the existing TPU
-        success = tpu_pod.setup_existing_pod(args.dockerfile, args.disk_name)
+        success = tpu_pod.setup_existing_pod(
+            args.dockerfile, args.disk_name, docker_image
+        )
         if success:
-            success = tpu_pod.setup_ray(args.dockerfile)
+            # setup_ray only needs to know whether Ray lives in a container.
+            success = tpu_pod.setup_ray(args.dockerfile or docker_image)
         else:
             raise RuntimeError("Failed to set up the pod slice.")
     else:
         logger.info(f"Creating new TPU pod '{args.name}'.")
+        # create passes the disk via --data-disk, so it must exist by now.
+        if not _disk_ready(disk_future, args):
+            return
+        # With a staging bucket, upload the Dockerfile once and let workers
+        # fetch it from GCS; on upload failure fall back to embedding.
+        dockerfile_gcs_path = None
+        staging_bucket = getattr(args, "staging_bucket", None)
+        if staging_bucket and args.dockerfile and not docker_image:
+            dockerfile_gcs_path = upload_dockerfile_to_gcs(
+                args.dockerfile, staging_bucket
+            )
         success = tpu_pod.create(
-            args.accelerator_type, args.version, dockerfile_content, args.disk_name
+            args.accelerator_type,
+            args.version,
+            dockerfile_content,
+            args.disk_name,
+            docker_image,
+            dockerfile_gcs_path,
         )
+        # `gcloud compute tpus tpu-vm create` blocks on the create
+        # operation server-side, so the pod is READY once it returns;
+        # no describe polling is needed on this path.
         if success:
-            tpu_pod.wait_until_ready()
-            success = tpu_pod.setup_ray(dockerfile_content)
+            # The startup script runs asynchronously at boot — building the
+            # container in docker mode, installing Ray otherwise. Wait for
+            # its completion marker before starting Ray.
+            success = tpu_pod.wait_for_startup_script()
+        if success:
+            success = tpu_pod.setup_ray(
+                dockerfile_content or docker_image, ray_installed=True
+            )
 
     if success:
         logger.info(f"Ray cluster on TPU pod '{args.name}' is set up and ready.")